@@ -18,8 +18,7 @@
 """
 
 import sys
-import argparse
-import netsnmp
+import time
 
 __author__ = 'Eric Belhomme'
 __contact__ = 'rico-github@ricozome.net'
@@ -27,84 +26,156 @@ __version__ = '0.1.2'
 __license__ = 'MIT'
 
 nagiosStatus = {
-    '0': 'OK',
-    '1': 'WARNING',
-    '2': 'CRITICAL',
-    '3': 'UNKNOWN'
+    0: 'OK',
+    1: 'WARNING',
+    2: 'CRITICAL',
+    3: 'UNKNOWN'
+}
+
+# severity of each Nagios status when several results are merged: CRITICAL > WARNING > UNKNOWN > OK
+nagiosSeverity = {
+    0: 0,
+    3: 1,
+    1: 2,
+    2: 3
 }
 
 Os10CmnOperStatus = {
-    '1': 'up',
-    '2': 'down',
-    '3': 'testing',
-    '4': 'unknown',
-    '5': 'dormant',
-    '6': 'notPresent',
-    '7': 'lowerLayerDown',
-    '8': 'failed'
+    1: 'up',
+    2: 'down',
+    3: 'testing',
+    4: 'unknown',
+    5: 'dormant',
+    6: 'notPresent',
+    7: 'lowerLayerDown',
+    8: 'failed'
 }
 
 Os10ChassisDefType = {
-    '1': 's6000on',
-    '2': 's4048on',
-    '3': 's4048Ton',
-    '4': 's3048on',
-    '5': 's6010on',
-    '6': 's4148Fon',
-    '7': 's4128Fon',
-    '8': 's4148Ton',
-    '9': 's4128Ton',
-    '10': 's4148FEon',
-    '11': 's4148Uon',
-    '12': 's4200on',
-    '13': 'mx5108Non',
-    '14': 'mx9116Non',
-    '15': 's5148Fon',
-    '16': 'z9100on',
-    '17': 's4248FBon',
-    '18': 's4248FBLon',
-    '19': 's4112Fon',
-    '20': 's4112Ton',
-    '21': 'z9264Fon',
-    '22': 'z9224Fon',
-    '23': 's5212Fon',
-    '24': 's5224Fon',
-    '25': 's5232Fon',
-    '26': 's5248Fon',
-    '27': 's5296Fon',
-    '28': 'z9332Fon',
-    '29': 'n3248TEon',
-    '9999': 'unknown'
+    1: 's6000on',
+    2: 's4048on',
+    3: 's4048Ton',
+    4: 's3048on',
+    5: 's6010on',
+    6: 's4148Fon',
+    7: 's4128Fon',
+    8: 's4148Ton',
+    9: 's4128Ton',
+    10: 's4148FEon',
+    11: 's4148Uon',
+    12: 's4200on',
+    13: 'mx5108Non',
+    14: 'mx9116Non',
+    15: 's5148Fon',
+    16: 'z9100on',
+    17: 's4248FBon',
+    18: 's4248FBLon',
+    19: 's4112Fon',
+    20: 's4112Ton',
+    21: 'z9264Fon',
+    22: 'z9224Fon',
+    23: 's5212Fon',
+    24: 's5224Fon',
+    25: 's5232Fon',
+    26: 's5248Fon',
+    27: 's5296Fon',
+    28: 'z9332Fon',
+    29: 'n3248TEon',
+    9999: 'unknown'
 }
 
 Os10CardOperStatus = {
-    '1': 'ready',
-    '2': 'cardMisMatch',
-    '3': 'cardProblem',
-    '4': 'diagMode',
-    '5': 'cardAbsent',
-    '6': 'offline'
+    1: 'ready',
+    2: 'cardMisMatch',
+    3: 'cardProblem',
+    4: 'diagMode',
+    5: 'cardAbsent',
+    6: 'offline'
 }
 
 
+# fans and power checks ignore -w/-c and use these (warning, critical) failure counts
+FIXED_THRESHOLDS = {
+    'fans': (1, 2),
+    'power': (0, 1)
+}
+
+# varbinds requested per GETBULK PDU when walking tables: higher values save round-trips on
+# long tables, but too high a value makes responses exceed the MTU and risks UDP fragmentation
+MAX_REPETITIONS = 25
+
+# varbind types net-snmp reports when a walk runs past the end of what the agent exposes
+SNMP_END_OF_WALK_TYPES = ('ENDOFMIBVIEW', 'NOSUCHOBJECT', 'NOSUCHINSTANCE')
+
+# os10FanTrayOperStatus MIB
+FAN_OPER_STATUS_OID = '.1.3.6.1.4.1.674.11000.5000.100.4.1.2.2.1.4'
+# os10PowerSupplyOperStatus MIB
+PSU_OPER_STATUS_OID = '.1.3.6.1.4.1.674.11000.5000.100.4.1.2.1.1.4'
+
+SYSTEM_INFO_OIDS = (
+    '.1.3.6.1.2.1.1.5.0',                                   # sysName
+    '.1.3.6.1.2.1.1.2.0',                                   # sysObjectId
+    '.1.3.6.1.2.1.1.1.0',                                   # sysDescr
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.3.1.2.1',        # chassis type
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.3.1.6.1',        # chassis hw rev.
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.3.1.4.1',        # chassis p/n
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.3.1.7.1',        # chassis service tag
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.3.1.1',      # card descr
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.8.1.1',      # card h/w rev.
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.6.1.1',      # card P/N
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.4.1.1',      # card status
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.9.1.1')      # card Service Tag
+
+TEMPERATURE_OIDS = (
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.3.1.11.1',       # chassis temp.
+    '.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.5.1.1')      # card temp.
+
+
+def snmp_varlist(oids):
+    """Build a fresh VarList from OID strings (net-snmp mutates the Varbinds it is given)"""
+    import netsnmp
+    return netsnmp.VarList(*[netsnmp.Varbind(oid) for oid in oids])
+
+
+def snmp_bulkwalk(snmp_session, snmp_oid, max_repetitions=MAX_REPETITIONS):
+    """Walk an OID subtree with GETBULK requests instead of one GETNEXT per OID"""
+    vals = []
+    prefix = snmp_oid.strip('.') + '.'
+    last_oid = tuple(int(i) for i in snmp_oid.strip('.').split('.'))
+    varlist = snmp_varlist([snmp_oid])
+    while snmp_session.getbulk(0, max_repetitions, varlist):
+        for varbind in varlist:
+            oid = f'{varbind.tag}.{varbind.iid}'.strip('.')
+            if not oid.startswith(prefix) or varbind.val is None or varbind.type in SNMP_END_OF_WALK_TYPES:
+                return vals
+            # stop on agents that repeat or go back instead of looping forever
+            oid_index = tuple(int(i) for i in oid.split('.'))
+            if oid_index <= last_oid:
+                return vals
+            last_oid = oid_index
+            vals.append(varbind.val)
+        varlist = snmp_varlist(['.' + '.'.join(map(str, last_oid))])
+    return vals
+
+
 def get_snmp_oper_status(snmp_session, snmp_oid, hw_type, warn, crit):
     ret_code = 0
     messages = []
     count_fail = 0
-    varlist = netsnmp.VarList(netsnmp.Varbind(snmp_oid))
-    vals = snmp_session.walk(varlist)
+    vals = snmp_bulkwalk(snmp_session, snmp_oid)
 
     if not vals:
         return 3, ['Unable to get SNMP metrics from server !'], []
 
+    status_of = Os10CmnOperStatus.get
     for index, item in enumerate(vals, start=1):
-        status = int(item.decode("utf-8"))
+        status = int(item.decode())
         if status == 4:
             ret_code = 3
         else:
             if status != 1:
                 count_fail += 1
-        messages.append(f'{hw_type} #{str(index)} reported as {Os10CmnOperStatus.get(str(status))}')
+        messages.append(f'{hw_type} #{index} reported as {status_of(status)}')
 
     if ret_code != 3:
         if count_fail == 0:
@@ -112,10 +183,10 @@ def get_snmp_oper_status(snmp_session, snmp_oid, hw_type, warn, crit):
             messages.insert(0, f'All {hw_type} (s) OK')
         else:
             messages.insert(0, f'Failed or error found for {hw_type}')
-            if count_fail < warn:
-                ret_code = 1
-            if count_fail < crit:
+            if count_fail >= crit:
                 ret_code = 2
+            elif count_fail >= warn:
+                ret_code = 1
 
     return ret_code, messages, []
 
@@ -123,36 +194,19 @@ def get_snmp_oper_status(snmp_session, snmp_oid, hw_type, warn, crit):
 def get_system_info(snmp_session):
     ret_code = 0
     messages = []
-    varlist = netsnmp.VarList(
-        netsnmp.Varbind('.1.3.6.1.2.1.1.5', 0), # sysName
-        netsnmp.Varbind('.1.3.6.1.2.1.1.2', 0), # sysObjectId
-        netsnmp.Varbind('.1.3.6.1.2.1.1.1', 0)) # sysDescr
-    vals = [b.decode("utf-8") for b in snmp_session.get(varlist)]
-    if not vals or None in vals:
-        return 3, ['Unable to get SNMP metrics from server !'], []
-    messages.append(f'{vals[0]} ( {vals[1]} )\n{vals[2]}')
-
-    varlist = netsnmp.VarList(
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.3.1.2.1'), # chassis type
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.3.1.6.1'), # chassis hw rev.
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.3.1.4.1'), # chassis p/n
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.3.1.7.1')) # chassis service tag
-    vals = [b.decode("utf-8") for b in snmp_session.get(varlist)]
-    if not vals or None in vals:
+    # sysinfo, chassis and card OIDs are fetched in a single PDU
+    varlist = snmp_varlist(SYSTEM_INFO_OIDS)
+    raw = snmp_session.get(varlist)
+    if not raw or None in raw:
         return 3, ['Unable to get SNMP metrics from server !'], []
-    messages.append(f'Chassis: {Os10ChassisDefType.get(vals[0])} (rev. {vals[1]}) - p/n: {vals[2]} - ServiceTag: {vals[3]}')
-
-    varlist = netsnmp.VarList(
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.3.1.1'), # card descr
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.8.1.1'), # card h/w rev.
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.6.1.1'), # card P/N
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.4.1.1'), # card status
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.9.1.1')) # card Service Tag
-    vals = [b.decode("utf-8") for b in snmp_session.get(varlist)]
-    if not vals or None in vals:
-        return 3, ['Unable to get SNMP metrics from server !'], []
-    card_status = int(vals[3])
-    messages.append(f'Card: {vals[0]} (rev. {vals[1]}) - p/n: {vals[2]} - ServiceTag: {vals[4]} - Status: {Os10CardOperStatus.get(vals[3])}')
+    vals = [b.decode() for b in raw]
+    sysinfo, chassis, card = vals[0:3], vals[3:7], vals[7:12]
+
+    messages.append(f'{sysinfo[0]} ( {sysinfo[1]} )\n{sysinfo[2]}')
+    messages.append(f'Chassis: {Os10ChassisDefType.get(int(chassis[0]))} (rev. {chassis[1]}) - p/n: {chassis[2]} - ServiceTag: {chassis[3]}')
+
+    card_status = int(card[3])
+    messages.append(f'Card: {card[0]} (rev. {card[1]}) - p/n: {card[2]} - ServiceTag: {card[4]} - Status: {Os10CardOperStatus.get(card_status)}')
 
     if card_status != 1:
         if (card_status == 4 or card_status == 6) and ret_code < 1:
@@ -167,72 +221,181 @@ def get_temperatures(snmp_session, warn, crit):
     ret_code = 0
     messages = []
     perf_data = []
-    varlist = netsnmp.VarList(
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.3.1.11.1'),   # chassis temp.
-        netsnmp.Varbind('.1.3.6.1.4.1.674.11000.5000.100.4.1.1.4.1.5.1.1'))  # card temp.
-    vals = list(map(lambda b: b.decode("utf-8"), snmp_session.get(varlist)))
-    if not vals or None in vals:
+    varlist = snmp_varlist(TEMPERATURE_OIDS)
+    raw = snmp_session.get(varlist)
+    if not raw or None in raw:
         return 3, ['Unable to get SNMP metrics from server !'], []
+    vals = [b.decode() for b in raw]
 
-    for index, temp in enumerate(vals, start=1):
-        if int(temp) > crit and ret_code < 2:
+    temps = [int(t) for t in vals]
+    for index, temp in enumerate(temps, start=1):
+        if temp > crit and ret_code < 2:
             ret_code = 2
-            messages.append(f'Temperature sensor at {str(temp)}°C exceeds critical threshold ({str(crit)}°C)')
-        elif int(temp) > warn and ret_code < 1:
+            messages.append(f'Temperature sensor at {temp}°C exceeds critical threshold ({crit}°C)')
+        elif temp > warn and ret_code < 1:
             ret_code = 1
-            messages.append(f'Temperature sensor at {str(temp)}°C exceeds warning threshold ({str(warn)}°C)')
+            messages.append(f'Temperature sensor at {temp}°C exceeds warning threshold ({warn}°C)')
         else:
-            messages.append(f'Temperature sensor at {str(temp)}°C')
-            perf_data.append(f'temp{index}={str(temp)}°C;{str(warn)};{str(crit)}')
+            messages.append(f'Temperature sensor at {temp}°C')
+            perf_data.append(f'temp{index}={temp}°C;{warn};{crit}')
     if ret_code == 0:
-        avg = sum(map(int, vals)) / len(vals)
-        messages.insert(0, f'All temperature sensors OK with an average of {str(avg)}°C')
+        avg = sum(temps) / len(temps)
+        messages.insert(0, f'All temperature sensors OK with an average of {avg}°C')
 
     return ret_code, messages, perf_data
 
 
+USAGE = 'usage: check_dell_s_series.py [-h] [-V] -H HOST [-C COMMUNITY] -m {fans,power,health,temp,all} [-w WARNING] [-c CRITICAL] [-t TIMEOUT] [-r RETRIES] [-n HOSTNAME] [-s SERVICE_PREFIX]'
+
+HELP = f"""{USAGE}
+
+Nagios check plugin for Dell|EMC S-series switches running OS10 firmware
+
+options:
+  -h, --help            show this help message and exit
+  -V, --version         show program's version number and exit
+  -H, --host HOST       IP address
+  -C, --community COMMUNITY
+                        SNMPv2 community (default: public)
+  -m, --mode MODE       Check mode: fans, power, health, temp, or all to run every
+                        check and print passive check results
+  -w, --warning WARNING
+                        Warning threshold (default: 50)
+  -c, --critical CRITICAL
+                        Critical threshold (default: 60)
+  -t, --timeout TIMEOUT
+                        SNMP request timeout in seconds (default: 1)
+  -r, --retries RETRIES
+                        SNMP retries after a timeout (default: 1)
+  -n, --hostname HOSTNAME
+                        Nagios host name used in -m all results (default: HOST)
+  -s, --service-prefix SERVICE_PREFIX
+                        Prefix added to the mode name to build the Nagios service
+                        description in -m all results (default: none)"""
+
+# option flag -> get_args() setting name
+OPTIONS = {
+    '-H': 'host', '--host': 'host',
+    '-C': 'community', '--community': 'community',
+    '-m': 'mode', '--mode': 'mode',
+    '-w': 'warning', '--warning': 'warning',
+    '-c': 'critical', '--critical': 'critical',
+    '-t': 'timeout', '--timeout': 'timeout',
+    '-r': 'retries', '--retries': 'retries',
+    '-n': 'hostname', '--hostname': 'hostname',
+    '-s': 'service_prefix', '--service-prefix': 'service_prefix'
+}
+
+
+def usage_error(message):
+    print(f'UNKNOWN: {message}\n{USAGE}')
+    sys.exit(3)
+
+
 def get_args():
-    parser = argparse.ArgumentParser(description="Nagios check plugin for Dell|EMC S-series switches running OS10 firmware")
-    parser.add_argument('--version', '-V', action='version', version=f"%(prog)s {__version__} - {__author__} <{__contact__}> - {__license__} license")
-    parser.add_argument('-H', '--host', required=True, help='IP address')
-    parser.add_argument('-C', '--community', default='public', help='SNMPv2 community')
-    parser.add_argument('-m', '--mode', required=True, choices=['fans', 'power', 'health', 'temp'], help='Check mode')
-    parser.add_argument('-w', '--warning', type=int, help='Warning threshold', default=50)
-    parser.add_argument('-c', '--critical', type=int, help='Critical threshold', default=60)
-    args = parser.parse_args()
-    if args.mode == 'fans':
-        args.warning = 1
-        args.critical = 2
-    elif args.mode == 'power':
-        args.warning = 0
-        args.critical = 1
-    return args.host, args.community, args.mode, args.warning, args.critical
+    """Parse the command line by hand, avoiding the argparse import on every check"""
+    args = {'community': 'public', 'warning': '50', 'critical': '60', 'timeout': '1', 'retries': '1', 'service_prefix': ''}
+    argv = iter(sys.argv[1:])
+    for arg in argv:
+        if arg[:2] in OPTIONS and len(arg) > 2:
+            # attached short option value, e.g. -H10.0.0.1 or -H=10.0.0.1
+            flag, has_value, value = arg[:2], True, arg[3:] if arg[2] == '=' else arg[2:]
+        else:
+            flag, has_value, value = arg.partition('=')
+            if flag.startswith('--') and len(flag) > 2 and flag not in OPTIONS:
+                # unique prefix of a long option, e.g. --comm
+                matches = [o for o in (*OPTIONS, '--help', '--version') if o.startswith(flag)]
+                if len(matches) > 1:
+                    usage_error(f"ambiguous option: {flag} could match {', '.join(matches)}")
+                if matches:
+                    flag = matches[0]
+        if flag in ('-h', '--help'):
+            print(HELP)
+            sys.exit(0)
+        if flag in ('-V', '--version'):
+            print(f"check_dell_s_series.py {__version__} - {__author__} <{__contact__}> - {__license__} license")
+            sys.exit(0)
+        if flag not in OPTIONS:
+            usage_error(f'unrecognized argument: {arg}')
+        if not has_value:
+            value = next(argv, None)
+            if value is None:
+                usage_error(f'argument {flag} expects a value')
+        args[OPTIONS[flag]] = value
+
+    for name in ('host', 'mode'):
+        if name not in args:
+            usage_error(f'argument --{name} is required')
+    if args['mode'] not in CHECKS and args['mode'] != 'all':
+        usage_error(f"invalid mode: {args['mode']}")
+    try:
+        warn, crit = int(args['warning']), int(args['critical'])
+    except ValueError:
+        usage_error('warning and critical thresholds must be integers')
+    try:
+        # netsnmp takes the timeout in microseconds, validate what it will actually get
+        timeout, retries = int(float(args['timeout']) * 1000000), int(args['retries'])
+    except (ValueError, OverflowError):
+        usage_error('timeout must be a number of seconds and retries an integer')
+    # Nagios kills checks after 60 seconds by default anyway
+    if not 0 < timeout <= 60000000:
+        usage_error('timeout must be at least 1 microsecond and at most 60 seconds')
+    if retries < 0:
+        usage_error('retries must not be negative')
+    if args['mode'] in FIXED_THRESHOLDS:
+        warn, crit = FIXED_THRESHOLDS[args['mode']]
+    hostname = args.get('hostname', args['host'])
+    return args['host'], args['community'], args['mode'], warn, crit, timeout, retries, hostname, args['service_prefix']
+
+
+# check mode -> check function called with (snmp_session, warn, crit)
+CHECKS = {
+    'fans': lambda snmp_session, warn, crit: get_snmp_oper_status(snmp_session, FAN_OPER_STATUS_OID, 'fan', warn, crit),
+    'power': lambda snmp_session, warn, crit: get_snmp_oper_status(snmp_session, PSU_OPER_STATUS_OID, 'PSU', warn, crit),
+    'health': lambda snmp_session, warn, crit: get_system_info(snmp_session),
+    'temp': get_temperatures
+}
 
 
-def main():
-    ret_code = 3
-    msg = []
-    perf_data = []
-    host, community, mode, warn, crit = get_args()
-    snmp_session = netsnmp.Session(Version = 2, DestHost=host, Community=community)
-
-    if mode == 'fans':
-        # os10FanTrayOperStatus MIB
-        ret_code, msg, perf_data = get_snmp_oper_status(snmp_session, '.1.3.6.1.4.1.674.11000.5000.100.4.1.2.2.1.4', 'fan', warn, crit)
-    if mode == 'power':
-        # os10PowerSupplyOperStatus MIB
-        ret_code, msg, perf_data = get_snmp_oper_status(snmp_session, '.1.3.6.1.4.1.674.11000.5000.100.4.1.2.1.1.4', 'PSU', warn, crit)
-    if mode == 'temp':
-        ret_code, msg, perf_data = get_temperatures(snmp_session, warn, crit)
-    if mode == 'health':
-        ret_code, msg, perf_data = get_system_info(snmp_session)
-
-    output = f'{nagiosStatus.get(str(ret_code))}: '
-    if msg:
-        output += '\n'.join(msg)
+def run_check(snmp_session, mode, warn, crit):
+    return CHECKS[mode](snmp_session, warn, crit)
+
+
+def format_output(ret_code, msg, perf_data):
+    output = f'{nagiosStatus.get(ret_code)}: ' + '\n'.join(msg)
     if perf_data:
-        output += " | " + " ".join(sorted(perf_data))
-    print(output)
+        output = f'{output} | {" ".join(perf_data)}'
+    return output
+
+
+def run_all_checks(snmp_session, hostname, service_prefix, warn, crit):
+    """Run every check on one session and print them as Nagios PROCESS_SERVICE_CHECK_RESULT
+       external commands for host hostname, with service_prefix + mode as service description"""
+    worst = 0
+    lines = []
+    now = int(time.time())
+    for mode in CHECKS:
+        mode_warn, mode_crit = FIXED_THRESHOLDS.get(mode, (warn, crit))
+        ret_code, msg, perf_data = run_check(snmp_session, mode, mode_warn, mode_crit)
+        output = format_output(ret_code, msg, perf_data).replace('\n', '\\n')
+        lines.append(f'[{now}] PROCESS_SERVICE_CHECK_RESULT;{hostname};{service_prefix}{mode};{ret_code};{output}\n')
+        worst = max(worst, ret_code, key=nagiosSeverity.get)
+    sys.stdout.write(''.join(lines))
+    return worst
+
+
+def main():
+    host, community, mode, warn, crit, timeout, retries, hostname, service_prefix = get_args()
+    # imported here so --help, --version and usage errors skip loading net-snmp
+    import netsnmp
+    snmp_session = netsnmp.Session(Version=2, DestHost=host, Community=community, UseNumeric=1,
+                                   Timeout=timeout, Retries=retries)
+
+    if mode == 'all':
+        sys.exit(run_all_checks(snmp_session, hostname, service_prefix, warn, crit))
+
+    ret_code, msg, perf_data = run_check(snmp_session, mode, warn, crit)
+    sys.stdout.write(format_output(ret_code, msg, perf_data) + '\n')
 
     sys.exit(ret_code)
 